@@ -5,6 +5,8 @@ Tests for the uflash module.
 import ctypes
 import os
 import os.path
+import select
+import struct
 import sys
 import tempfile
 import time
@@ -166,6 +168,32 @@ def test_unhexlify_not_python():
     )
 
 
+def test_unhexlify_no_records():
+    """
+    Test that an empty string is returned if there are no data records after
+    the extended address record.
+    """
+    assert "" == uflash.unhexlify(":020000040003F7")
+
+
+def test_unhexlify_odd_length_records():
+    """
+    Test that records with an odd number of hex digits (here caused by
+    Windows line endings) result in an empty string rather than garbage.
+    """
+    assert "" == uflash.unhexlify(TEST_SCRIPT_HEXLIFIED.replace("\n", "\r\n"))
+    assert "" == uflash.unhexlify(TEST_SCRIPT_HEXLIFIED[:-1])
+
+
+def test_unhexlify_not_hex():
+    """
+    Test that records with invalid hex digits result in an empty string.
+    """
+    assert "" == uflash.unhexlify(
+        ":020000040003F7\n:10E000004D50XXFFFFFFFFFFFFFFFFFFFFFFFFFFFF"
+    )
+
+
 def test_unhexlify_bad_unicode():
     """
     Test that invalid Unicode is dealt gracefully returning an empty string.
@@ -252,7 +280,9 @@ def test_find_microbit_posix_exists():
     """
     with open("tests/mount_exists.txt", "rb") as fixture_file:
         fixture = fixture_file.read()
-        with mock.patch("os.name", "posix"):
+        with mock.patch("os.name", "posix"), mock.patch(
+            "os.path.exists", return_value=False
+        ):
             with mock.patch("uflash.check_output", return_value=fixture):
                 assert uflash.find_microbit() == "/media/ntoll/MICROBIT"
 
@@ -264,11 +294,65 @@ def test_find_microbit_posix_missing():
     """
     with open("tests/mount_missing.txt", "rb") as fixture_file:
         fixture = fixture_file.read()
-        with mock.patch("os.name", "posix"):
+        with mock.patch("os.name", "posix"), mock.patch(
+            "os.path.exists", return_value=False
+        ):
             with mock.patch("uflash.check_output", return_value=fixture):
                 assert uflash.find_microbit() is None
 
 
+def test_find_microbit_mountinfo_exists():
+    """
+    Simulate being on Linux and /proc/self/mountinfo containing a record
+    indicating a connected micro:bit device. The "mount" command should not
+    be needed.
+    """
+    with open("tests/mountinfo_exists.txt", "rb") as fixture_file:
+        fixture = fixture_file.read()
+    with mock.patch("os.name", "posix"), mock.patch(
+        "os.path.exists", return_value=True
+    ), mock.patch("uflash.check_output") as mock_check_output:
+        with mock.patch(
+            "uflash.open", mock.mock_open(read_data=fixture), create=True
+        ) as mock_open:
+            assert uflash.find_microbit() == "/media/ntoll/MICROBIT"
+    mock_open.assert_called_once_with("/proc/self/mountinfo", "rb")
+    assert mock_check_output.call_count == 0
+
+
+def test_find_microbit_mountinfo_missing():
+    """
+    Simulate being on Linux and /proc/self/mountinfo containing no records
+    associated with a micro:bit device.
+    """
+    with open("tests/mountinfo_missing.txt", "rb") as fixture_file:
+        fixture = fixture_file.read()
+    with mock.patch("os.name", "posix"), mock.patch(
+        "os.path.exists", return_value=True
+    ):
+        with mock.patch(
+            "uflash.open", mock.mock_open(read_data=fixture), create=True
+        ):
+            assert uflash.find_microbit() is None
+
+
+def test_find_microbit_mountinfo_escaped_path():
+    """
+    Spaces in the micro:bit mount point are escaped in /proc/self/mountinfo.
+    """
+    fixture = (
+        b"413 22 8:16 / /media/my\\040user/MICROBIT rw,relatime shared:231 "
+        b"- vfat /dev/sdb rw,fmask=0022,dmask=0077\n"
+    )
+    with mock.patch("os.name", "posix"), mock.patch(
+        "os.path.exists", return_value=True
+    ):
+        with mock.patch(
+            "uflash.open", mock.mock_open(read_data=fixture), create=True
+        ):
+            assert uflash.find_microbit() == "/media/my user/MICROBIT"
+
+
 def test_find_microbit_nt_exists():
     """
     Simulate being on os.name == 'nt' and a disk with a volume name 'MICROBIT'
@@ -276,6 +360,7 @@ def test_find_microbit_nt_exists():
     """
     mock_windll = mock.MagicMock()
     mock_windll.kernel32 = mock.MagicMock()
+    mock_windll.kernel32.GetLogicalDrives.return_value = 0x3FFFFFF
     mock_windll.kernel32.GetVolumeInformationW = mock.MagicMock()
     mock_windll.kernel32.GetVolumeInformationW.return_value = None
     #
@@ -300,6 +385,7 @@ def test_find_microbit_nt_missing():
     """
     mock_windll = mock.MagicMock()
     mock_windll.kernel32 = mock.MagicMock()
+    mock_windll.kernel32.GetLogicalDrives.return_value = 0x3FFFFFF
     mock_windll.kernel32.GetVolumeInformationW = mock.MagicMock()
     mock_windll.kernel32.GetVolumeInformationW.return_value = None
     with mock.patch("os.name", "nt"):
@@ -330,6 +416,7 @@ def test_find_microbit_nt_removable_only():
 
     mock_windll = mock.MagicMock()
     mock_windll.kernel32 = mock.MagicMock()
+    mock_windll.kernel32.GetLogicalDrives.return_value = 0x3FFFFFF
     mock_windll.kernel32.GetVolumeInformationW = mock.MagicMock()
     mock_windll.kernel32.GetVolumeInformationW.return_value = None
     mock_windll.kernel32.GetDriveTypeW = mock.MagicMock()
@@ -344,6 +431,31 @@ def test_find_microbit_nt_removable_only():
                 assert uflash.find_microbit() == "B:\\"
 
 
+def test_find_microbit_nt_existing_drives_only():
+    """
+    Only the drive letters in use should be checked.
+
+    Have every drive claim to be a removable micro:bit, but only drives C:
+    and E: exist.
+    """
+    mock_windll = mock.MagicMock()
+    mock_windll.kernel32 = mock.MagicMock()
+    mock_windll.kernel32.GetLogicalDrives.return_value = 0b10100
+    mock_windll.kernel32.GetVolumeInformationW = mock.MagicMock()
+    mock_windll.kernel32.GetVolumeInformationW.return_value = None
+    mock_windll.kernel32.GetDriveTypeW = mock.MagicMock()
+    mock_windll.kernel32.GetDriveTypeW.return_value = 2
+    with mock.patch("os.name", "nt"):
+        with mock.patch("os.path.exists", return_value=True):
+            return_value = ctypes.create_unicode_buffer("MICROBIT")
+            with mock.patch(
+                "ctypes.create_unicode_buffer", return_value=return_value
+            ):
+                ctypes.windll = mock_windll
+                assert uflash.find_microbit() == "C:\\"
+    mock_windll.kernel32.GetDriveTypeW.assert_called_once_with("C:\\")
+
+
 def test_find_microbit_unknown_os():
     """
     Raises a NotImplementedError if the host OS is not supported.
@@ -373,6 +485,55 @@ def test_save_hex():
         assert written_file.read() == hex_file
 
 
+@pytest.mark.skipif(os.name != "posix", reason="POSIX permissions only")
+def test_save_hex_permissions():
+    """
+    Ensure the permissions of the written file are only limited by the umask,
+    as they would be with the built-in open function.
+    """
+    path_to_hex = os.path.join(tempfile.gettempdir(), "microbit.hex")
+    if os.path.exists(path_to_hex):
+        os.remove(path_to_hex)
+    old_umask = os.umask(0o002)
+    try:
+        uflash.save_hex(":00000001FF\n", path_to_hex)
+    finally:
+        os.umask(old_umask)
+    assert os.stat(path_to_hex).st_mode & 0o777 == 0o664
+
+
+def test_save_hex_bytes():
+    """
+    Ensure a hex file already encoded as bytes is written as is.
+    """
+    path_to_hex = os.path.join(tempfile.gettempdir(), "microbit.hex")
+    if os.path.exists(path_to_hex):
+        os.remove(path_to_hex)
+    hex_file = uflash.embed_fs_uhex(uflash._RUNTIME, TEST_SCRIPT)
+    uflash.save_hex(hex_file.encode("ascii"), path_to_hex)
+    with open(path_to_hex) as written_file:
+        assert written_file.read() == hex_file
+
+
+def test_save_hex_short_writes():
+    """
+    Ensure the whole hex file is written even if the OS doesn't write all the
+    data given to it in one go.
+    """
+    path_to_hex = os.path.join(tempfile.gettempdir(), "microbit.hex")
+    hex_file = uflash.embed_fs_uhex(uflash._RUNTIME, TEST_SCRIPT)
+    os_write = os.write
+
+    def short_write(fd, data):
+        return os_write(fd, data[:4096])
+
+    with mock.patch("os.write", side_effect=short_write) as mock_write:
+        uflash.save_hex(hex_file, path_to_hex)
+    assert mock_write.call_count == (len(hex_file) + 4095) // 4096
+    with open(path_to_hex) as written_file:
+        assert written_file.read() == hex_file
+
+
 def test_save_hex_no_hex():
     """
     The function raises a ValueError if no hex content is provided.
@@ -443,13 +604,69 @@ def test_flash_with_path_to_multiple_microbits():
         assert py_code
         expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_code)
 
-        assert mock_save.call_args_list[0][0][0] == expected_hex
+        # The micro:bits are flashed concurrently, so in any order, with the
+        # hex file already encoded as bytes
+        expected_hex = expected_hex.encode("ascii")
+        calls = sorted(call_args[0] for call_args in mock_save.call_args_list)
+        assert calls[0][0] == expected_hex
         expected_path = os.path.join("test_path1", "micropython.hex")
-        assert mock_save.call_args_list[0][0][1] == expected_path
+        assert calls[0][1] == expected_path
 
-        assert mock_save.call_args_list[1][0][0] == expected_hex
+        assert calls[1][0] == expected_hex
         expected_path = os.path.join("test_path2", "micropython.hex")
-        assert mock_save.call_args_list[1][0][1] == expected_path
+        assert calls[1][1] == expected_path
+
+
+def test_flash_with_path_to_multiple_microbits_raises():
+    """
+    If writing to any of the micro:bits fails, the error is raised once all
+    of them have been attempted.
+    """
+
+    def save_hex(hex_file, path):
+        if path.startswith("test_path2"):
+            raise IOError("boom")
+
+    with mock.patch("uflash.save_hex", side_effect=save_hex) as mock_save:
+        with pytest.raises(IOError) as ex:
+            uflash.flash("tests/example.py", ["test_path1", "test_path2"])
+    assert mock_save.call_count == 2
+    assert ex.value.args[0] == "boom"
+
+
+def test_flash_with_path_to_multiple_microbits_thread_limit():
+    """
+    The number of micro:bits written to at the same time is limited, each
+    thread flashing micro:bits until there are none left.
+    """
+    paths = ["test_path{}".format(i) for i in range(5)]
+    with mock.patch("uflash._MAX_FLASH_THREADS", 2), mock.patch(
+        "threading.Thread", wraps=threading.Thread
+    ) as mock_thread, mock.patch("uflash.save_hex") as mock_save:
+        uflash.flash("tests/example.py", paths)
+    assert mock_thread.call_count == 2
+    saved_paths = [call_args[0][1] for call_args in mock_save.call_args_list]
+    assert sorted(saved_paths) == [
+        os.path.join(path, "micropython.hex") for path in paths
+    ]
+
+
+def test_flash_with_path_to_multiple_microbits_no_parallel():
+    """
+    If the UFLASH_NO_PARALLEL environment variable is set, the micro:bits are
+    flashed one after another, in order.
+    """
+    with mock.patch.dict(os.environ, {"UFLASH_NO_PARALLEL": "1"}), mock.patch(
+        "threading.Thread"
+    ) as mock_thread, mock.patch("uflash.save_hex") as mock_save:
+        uflash.flash("tests/example.py", ["test_path1", "test_path2"])
+    assert mock_thread.call_count == 0
+    with open("tests/example.py", "rb") as py_file:
+        expected_hex = uflash.embed_fs_uhex(uflash._RUNTIME, py_file.read())
+    assert mock_save.call_args_list == [
+        mock.call(expected_hex, os.path.join("test_path1", "micropython.hex")),
+        mock.call(expected_hex, os.path.join("test_path2", "micropython.hex")),
+    ]
 
 
 def test_flash_with_path_to_microbit():
@@ -779,6 +996,7 @@ def test_watch_file(mock_os, mock_time):
 
     # Instead of modifying any file, let's change the return value of
     # os.path.getmtime. Start with initial value of 0.
+    mock_os.environ = {"UFLASH_WATCH_POLL": "1"}
     mock_os.path.getmtime.return_value = 0
 
     t = threading.Thread(target=uflash.watch_file, args=("path/to/file", func))
@@ -793,6 +1011,110 @@ def test_watch_file(mock_os, mock_time):
     assert call_count[0] == 2
 
 
+def test_watch_file_inotify():
+    """
+    Make sure that when inotify is available the callback is called each time
+    it reports the file has been written to, without polling.
+    """
+    call_count = [0]
+
+    def func():
+        call_count[0] = call_count[0] + 1
+
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    with mock.patch("uflash.inotify_watch", return_value=read_fd), mock.patch(
+        "uflash.inotify_wait", side_effect=[None, None, KeyboardInterrupt]
+    ) as mock_wait, mock.patch("uflash.time") as mock_time, mock.patch(
+        "os.path.getmtime", return_value=0
+    ), mock.patch.dict(
+        os.environ, clear=True
+    ):
+        uflash.watch_file("path/to/file", func)
+    assert call_count[0] == 2
+    assert mock_wait.call_count == 3
+    mock_wait.assert_called_with(read_fd, "path/to/file")
+    assert mock_time.sleep.call_count == 0
+    # The inotify file descriptor is closed when watching stops
+    with pytest.raises(OSError):
+        os.close(read_fd)
+
+
+inotify_only = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+
+
+def _wait_readable(fd):
+    """
+    Returns True if the file descriptor can be read from within a second, so
+    a broken test doesn't block forever in inotify_wait.
+    """
+    return bool(select.select([fd], [], [], 1)[0])
+
+
+@inotify_only
+def test_inotify_wait():
+    """
+    Make sure inotify_wait returns when the watched file is written to,
+    ignoring other files in the same directory.
+    """
+    watch_dir = tempfile.mkdtemp()
+    path = os.path.join(watch_dir, "main.py")
+    with open(path, "w") as script:
+        script.write("pass")
+    inotify_fd = uflash.inotify_watch(path)
+    assert inotify_fd is not None
+    try:
+        with open(os.path.join(watch_dir, "other.py"), "w") as other:
+            other.write("pass")
+        assert _wait_readable(inotify_fd)
+        with open(path, "w") as script:
+            script.write("pass\n")
+        uflash.inotify_wait(inotify_fd, path)
+        # All the events have been read
+        assert not select.select([inotify_fd], [], [], 0)[0]
+    finally:
+        os.close(inotify_fd)
+
+
+@inotify_only
+def test_inotify_wait_directory_removed():
+    """
+    Make sure inotify_wait raises an IOError if the watched directory goes
+    away, rather than blocking forever.
+    """
+    watch_dir = tempfile.mkdtemp()
+    path = os.path.join(watch_dir, "main.py")
+    inotify_fd = uflash.inotify_watch(path)
+    assert inotify_fd is not None
+    try:
+        os.rmdir(watch_dir)
+        assert _wait_readable(inotify_fd)
+        with pytest.raises(IOError):
+            uflash.inotify_wait(inotify_fd, path)
+    finally:
+        os.close(inotify_fd)
+
+
+def test_inotify_wait_queue_overflow():
+    """
+    Make sure inotify_wait returns if events were lost, as one of them may
+    have been for the watched file.
+    """
+    event = struct.pack("iIII", -1, uflash._IN_Q_OVERFLOW, 0, 0)
+    with mock.patch("os.read", return_value=event):
+        uflash.inotify_wait(3, "main.py")
+
+
+def test_inotify_watch_not_linux():
+    """
+    There's no inotify file descriptor if not running on Linux.
+    """
+    with mock.patch("sys.platform", "win32"):
+        assert uflash.inotify_watch("main.py") is None
+
+
 def test_py2hex_one_arg():
     """
     Test a simple call to main().
@@ -1170,6 +1492,64 @@ def test_embed_fs_uhex():
     assert uhex_alignment == (len(uhex_with_fs) % 512)
 
 
+def test_split_uhex_sections():
+    """
+    Test the Universal Hex is split into the contents before and after the
+    filesystem injection point of each section, and the result is cached.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+
+    sections = uflash.split_uhex_sections(uhex)
+
+    assert isinstance(sections, tuple)
+    assert len(sections) == 2
+    assert sections[0] == (
+        "\n".join(TEST_UNIVERSAL_HEX_LIST[:TEST_UHEX_V1_INSERTION_INDEX])
+        + "\n",
+        uflash._MICROBIT_ID_V1,
+        "\n".join(TEST_UNIVERSAL_HEX_LIST[TEST_UHEX_V1_INSERTION_INDEX:14])
+        + "\n",
+    )
+    assert sections[1] == (
+        "\n".join(TEST_UNIVERSAL_HEX_LIST[14:TEST_UHEX_V2_INSERTION_INDEX])
+        + "\n",
+        uflash._MICROBIT_ID_V2,
+        "\n".join(TEST_UNIVERSAL_HEX_LIST[TEST_UHEX_V2_INSERTION_INDEX:]),
+    )
+    assert uflash.split_uhex_sections(uhex) is sections
+
+
+def test_embed_fs_uhex_script_too_long():
+    """
+    Test embed_fs_uhex checks the script fits in every section before
+    encoding the filesystem for any of them.
+    """
+    uhex = "\n".join(TEST_UNIVERSAL_HEX_LIST)
+    # Fits in the V1 filesystem, but not in the smaller V2 filesystem
+    script = b"shouldfit" * 3000
+
+    with mock.patch("uflash.script_to_fs") as mock_script_to_fs:
+        with pytest.raises(ValueError) as ex:
+            uflash.embed_fs_uhex(uhex, script)
+
+    assert "Python script must be less than" in ex.value.args[0]
+    assert mock_script_to_fs.call_count == 0
+
+
+def test_check_script_size_line_endings():
+    """
+    Test Windows line endings are counted as converted by script_to_fs.
+    """
+    script = (b"shouldfit" * 3023)[:-1]
+    script_win_lines = script[:-5] + b"\r\n" * 5
+    assert len(script_win_lines) > len(script)
+    uflash.check_script_size(script_win_lines, uflash._MICROBIT_ID_V1)
+
+    with pytest.raises(ValueError) as ex:
+        uflash.check_script_size(script + b"\r\n", uflash._MICROBIT_ID_V1)
+    assert "Python script must be less than" in ex.value.args[0]
+
+
 def test_pad_hex_records():
     """
     Test the function pads a generic fs hex block to 512 byte alignment.
@@ -15,12 +15,20 @@ from __future__ import print_function
 import argparse
 import binascii
 import ctypes
+import ctypes.util
 import os
+import re
 import struct
 import sys
 from subprocess import check_output
+import threading
 import time
 
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue  # Python 2
+
 
 #: The help text to be shown by uflash  when requested.
 _HELP_TEXT = """
@@ -70,6 +78,24 @@ _MAX_SIZE = min(
     _FS_END_ADDR_V2 - _FS_START_ADDR_V2, _FS_END_ADDR_V1 - _FS_START_ADDR_V1
 )
 
+#: Maximum number of micro:bits to write to at the same time.
+_MAX_FLASH_THREADS = 32
+
+#: Filesystem chunks configured in MicroPython, 1st & last bytes are the
+#: prev/next chunk pointers.
+_FS_CHUNK_SIZE = 128
+_FS_CHUNK_DATA_SIZE = 126
+
+#: inotify events (from <sys/inotify.h>) that trigger a watched file change.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+#: inotify events always reported, for a removed watch and lost events.
+_IN_IGNORED = 0x00008000
+_IN_Q_OVERFLOW = 0x00004000
+
+#: Universal Hex sections already split by split_uhex_sections.
+_UHEX_SECTIONS_CACHE = {}
+
 
 def get_version():
     """
@@ -85,6 +111,44 @@ def strfunc(raw):
     return str(raw) if sys.version_info[0] == 2 else str(raw, "utf-8")
 
 
+def fs_boundaries(microbit_version_id):
+    """
+    Returns the start and end addresses of the MicroPython filesystem for the
+    given micro:bit version ID, and whether its data is stored in Universal
+    Hex V2 data records.
+
+    Will raise a ValueError if the micro:bit version ID is not recognised.
+    """
+    if microbit_version_id == _MICROBIT_ID_V1:
+        return _FS_START_ADDR_V1, _FS_END_ADDR_V1, False
+    elif microbit_version_id == _MICROBIT_ID_V2:
+        return _FS_START_ADDR_V2, _FS_END_ADDR_V2, True
+    raise ValueError(
+        "Incompatible micro:bit ID found: {}".format(microbit_version_id)
+    )
+
+
+def check_script_size(script, microbit_version_id):
+    """
+    Raises a ValueError if a Python script (in bytes format) doesn't fit in
+    the MicroPython filesystem of the given micro:bit version ID.
+
+    Windows line endings are counted as they will be once converted by
+    script_to_fs, so this check can be done before any encoding work.
+    """
+    fs_start_address, fs_end_address, _ = fs_boundaries(microbit_version_id)
+    fs_size = fs_end_address - fs_start_address
+    # Total file size depends on data and filename length, as uFlash only
+    # supports a single file with a known name (main.py) we can calculate it
+    main_py_max_size = ((fs_size / _FS_CHUNK_SIZE) * _FS_CHUNK_DATA_SIZE) - 9
+    if len(script) - script.count(b"\r\n") >= main_py_max_size:
+        raise ValueError(
+            "Python script must be less than {} bytes.".format(
+                main_py_max_size
+            )
+        )
+
+
 def script_to_fs(script, microbit_version_id):
     """
     Convert a Python script (in bytes format) into Intel Hex records, which
@@ -100,32 +164,15 @@ def script_to_fs(script, microbit_version_id):
     script = script.replace(b"\r\n", b"\n")
     script = script.replace(b"\r", b"\n")
 
-    # Find fs boundaries based on micro:bit version ID
-    if microbit_version_id == _MICROBIT_ID_V1:
-        fs_start_address = _FS_START_ADDR_V1
-        fs_end_address = _FS_END_ADDR_V1
-        universal_data_record = False
-    elif microbit_version_id == _MICROBIT_ID_V2:
-        fs_start_address = _FS_START_ADDR_V2
-        fs_end_address = _FS_END_ADDR_V2
-        universal_data_record = True
-    else:
-        raise ValueError(
-            "Incompatible micro:bit ID found: {}".format(microbit_version_id)
-        )
+    (
+        fs_start_address,
+        fs_end_address,
+        universal_data_record,
+    ) = fs_boundaries(microbit_version_id)
+    check_script_size(script, microbit_version_id)
 
-    chunk_size = 128  # Filesystem chunks configure in MP to 128 bytes
-    chunk_data_size = 126  # 1st & last bytes are the prev/next chunk pointers
-    fs_size = fs_end_address - fs_start_address
-    # Total file size depends on data and filename length, as uFlash only
-    # supports a single file with a known name (main.py) we can calculate it
-    main_py_max_size = ((fs_size / chunk_size) * chunk_data_size) - 9
-    if len(script) >= main_py_max_size:
-        raise ValueError(
-            "Python script must be less than {} bytes.".format(
-                main_py_max_size
-            )
-        )
+    chunk_size = _FS_CHUNK_SIZE
+    chunk_data_size = _FS_CHUNK_DATA_SIZE
 
     # First file chunk opens with:
     # 0xFE - First byte indicates a file start
@@ -220,26 +267,22 @@ def pad_hex_string(hex_records_str, alignment=512):
     return hex_records_str
 
 
-def embed_fs_uhex(universal_hex_str, python_code=None):
+def split_uhex_sections(universal_hex_str):
     """
-    Given a string representing a MicroPython Universal Hex, it will embed a
-    Python script encoded into the MicroPython filesystem for each of the
-    Universal Hex sections, as the Universal Hex will contain a section for
-    micro:bit V1 and a section for micro:bit V2.
+    Separates a string representing a MicroPython Universal Hex into its
+    sections and works out where in each section the filesystem should be
+    injected.
 
-    More information about the Universal Hex format:
-    https://github.com/microbit-foundation/spec-universal-hex
-
-    Returns a string of the Universal Hex with the embedded filesystem.
-
-    Will raise a ValueError if the Universal Hex doesn't follow the expected
-    format.
+    Returns a tuple with a tuple for each section containing the section
+    contents before the injection point, the micro:bit device ID of the
+    section and the section contents after the injection point.
 
-    If the python_code is missing, it will return the unmodified
-    universal_hex_str.
+    The result only depends on the Universal Hex, so it is cached to avoid
+    searching the same (very long) runtime string every time a script is
+    flashed.
     """
-    if not python_code:
-        return universal_hex_str
+    if universal_hex_str in _UHEX_SECTIONS_CACHE:
+        return _UHEX_SECTIONS_CACHE[universal_hex_str]
     # First let's separate the Universal Hex into the individual sections,
     # Each section starts with an Extended Linear Address record (:02000004...)
     # followed by s Block Start record (:0400000A...)
@@ -253,17 +296,13 @@ def embed_fs_uhex(universal_hex_str, python_code=None):
         universal_hex_str[second_section_i:],
     ]
 
-    # Now for each section we add the Python code to the filesystem
-    full_uhex_with_fs = ""
+    split_sections = []
     for section in uhex_sections:
         # Block Start record starts like this, followed by device ID (4 chars)
         block_start_record_start = ":0400000A"
         block_start_record_i = section.find(block_start_record_start)
         device_id_i = block_start_record_i + len(block_start_record_start)
         device_id = section[device_id_i : device_id_i + 4]
-        # With the device ID we can encode the fs into hex records to inject
-        fs_hex = script_to_fs(python_code, device_id)
-        fs_hex = pad_hex_string(fs_hex)
         # In all Sections the fs will be placed at the end of the hex, right
         # before the UICR, this is for compatibility with all DAPLink versions.
         # V1 memory layout in sequential order: MicroPython + fs + UICR
@@ -283,9 +322,50 @@ def embed_fs_uhex(universal_hex_str, python_code=None):
         esa_record = ":020000020000FC\n"
         if section[:uicr_i].endswith(esa_record):
             uicr_i -= len(esa_record)
+        split_sections.append((section[:uicr_i], device_id, section[uicr_i:]))
+
+    # Only a handful of different runtimes are expected, so keep it small
+    if len(_UHEX_SECTIONS_CACHE) >= 4:
+        _UHEX_SECTIONS_CACHE.clear()
+    # A tuple, so the cached value can't be modified by any of the callers
+    split_sections = tuple(split_sections)
+    _UHEX_SECTIONS_CACHE[universal_hex_str] = split_sections
+    return split_sections
+
+
+def embed_fs_uhex(universal_hex_str, python_code=None):
+    """
+    Given a string representing a MicroPython Universal Hex, it will embed a
+    Python script encoded into the MicroPython filesystem for each of the
+    Universal Hex sections, as the Universal Hex will contain a section for
+    micro:bit V1 and a section for micro:bit V2.
+
+    More information about the Universal Hex format:
+    https://github.com/microbit-foundation/spec-universal-hex
+
+    Returns a string of the Universal Hex with the embedded filesystem.
+
+    Will raise a ValueError if the Universal Hex doesn't follow the expected
+    format.
+
+    If the python_code is missing, it will return the unmodified
+    universal_hex_str.
+    """
+    if not python_code:
+        return universal_hex_str
+    uhex_sections = split_uhex_sections(universal_hex_str)
+    # Make sure the script fits in all the sections before encoding any
+    for _, device_id, _ in uhex_sections:
+        check_script_size(python_code, device_id)
+    # For each section we add the Python code to the filesystem
+    full_uhex_with_fs = []
+    for head, device_id, tail in uhex_sections:
+        # With the device ID we can encode the fs into hex records to inject
+        fs_hex = script_to_fs(python_code, device_id)
+        fs_hex = pad_hex_string(fs_hex)
         # Now we know where to inject the fs hex block
-        full_uhex_with_fs += section[:uicr_i] + fs_hex + section[uicr_i:]
-    return full_uhex_with_fs
+        full_uhex_with_fs.extend((head, fs_hex, tail))
+    return "".join(full_uhex_with_fs)
 
 
 def bytes_to_ihex(addr, data, universal_data_record=False):
@@ -305,14 +385,33 @@ def bytes_to_ihex(addr, data, universal_data_record=False):
     record type.
     """
 
-    def make_record(data):
-        checksump = (-(sum(bytearray(data)))) & 0xFF
-        return ":%s%02X" % (strfunc(binascii.hexlify(data)).upper(), checksump)
+    def make_record(r_type, offset, data, data_hex):
+        # The checksum is the two's complement of the sum of all record bytes,
+        # which can be calculated from the fields without packing them first
+        checksum = -(
+            len(data)
+            + (offset >> 8)
+            + (offset & 0xFF)
+            + r_type
+            + sum(bytearray(data))
+        )
+        return ":%02X%04X%02X%s%02X" % (
+            len(data),
+            offset,
+            r_type,
+            data_hex,
+            checksum & 0xFF,
+        )
+
+    def make_ela_record(ela):
+        return make_record(0x04, 0x0000, struct.pack(">H", ela), "%04X" % ela)
+
+    # Hexlify all the data in one go and slice out each record's payload
+    data_hex = strfunc(binascii.hexlify(data)).upper()
 
     # First create an Extended Linear Address Intel Hex record
     current_ela = (addr >> 16) & 0xFFFF
-    ela_chunk = struct.pack(">BHBH", 0x02, 0x0000, 0x04, current_ela)
-    output = [make_record(ela_chunk)]
+    output = [make_ela_record(current_ela)]
     # If the data is meant to go into a Universal Hex V2 section, then the
     # record type needs to be 0x0D instead of 0x00 (V1 section still uses 0x00)
     r_type = 0x0D if universal_data_record else 0x00
@@ -321,12 +420,11 @@ def bytes_to_ihex(addr, data, universal_data_record=False):
         # If we've jumped to the next 0x10000 address we'll need an ELA record
         if ((addr >> 16) & 0xFFFF) != current_ela:
             current_ela = (addr >> 16) & 0xFFFF
-            ela_chunk = struct.pack(">BHBH", 0x02, 0x0000, 0x04, current_ela)
-            output.append(make_record(ela_chunk))
+            output.append(make_ela_record(current_ela))
         # Now the data record
-        chunk = data[i : min(i + 16, len(data))]
-        chunk = struct.pack(">BHB", len(chunk), addr & 0xFFFF, r_type) + chunk
-        output.append(make_record(chunk))
+        chunk = data[i : i + 16]
+        chunk_hex = data_hex[i * 2 : i * 2 + 32]
+        output.append(make_record(r_type, addr & 0xFFFF, chunk, chunk_hex))
         addr += 16
     return "\n".join(output)
 
@@ -340,18 +438,23 @@ def unhexlify(blob):
     it is called by extract_script, which is maintained for Mu access.
     """
     lines = blob.split("\n")[1:]
-    output = []
-    for line in lines:
-        # Discard the address, length etc. and reverse the hexlification
-        output.append(binascii.unhexlify(line[9:-2]))
+    # Discard the address, length etc.
+    payloads = [line[9:-2] for line in lines]
+    # A record with an odd number of hex digits isn't valid (e.g. it was
+    # truncated or has Windows line endings), and joined with another one it
+    # would decode into shifted garbage
+    if any(len(payload) % 2 for payload in payloads):
+        return ""
+    # Reverse the hexlification of all the records in one go
+    try:
+        output = binascii.unhexlify("".join(payloads))
+    except (binascii.Error, TypeError):
+        return ""
     # Check the header is correct ("MP<size>")
-    if output[0][0:2].decode("utf-8") != u"MP":
+    if output[0:2] != b"MP":
         return ""
-    # Strip off header
-    output[0] = output[0][4:]
-    # and strip any null bytes from the end
-    output[-1] = output[-1].strip(b"\x00")
-    script = b"".join(output)
+    # Strip off header and any null bytes from the end
+    script = output[4:].rstrip(b"\x00")
     try:
         result = script.decode("utf-8")
         return result
@@ -371,36 +474,50 @@ def extract_script(embedded_hex):
     IMPORTANT!
     Although this function is no longer used, it is maintained here for Mu.
     """
-    hex_lines = embedded_hex.split("\n")
-    script_addr_high = hex((_SCRIPT_ADDR >> 16) & 0xFFFF)[2:].upper().zfill(4)
-    script_addr_low = hex(_SCRIPT_ADDR & 0xFFFF)[2:].upper().zfill(4)
+    script_addr_high = "%04X" % ((_SCRIPT_ADDR >> 16) & 0xFFFF)
+    script_addr_low = "%04X" % (_SCRIPT_ADDR & 0xFFFF)
+    # Look for the first data record at the script start address that comes
+    # after an extended address record within the script range, without any
+    # other extended address record in between. The extended address of the
+    # script range has no letters, so unlike the record address it doesn't
+    # need a case insensitive search.
+    ela_record = "\n:02000004"
+    script_record = re.compile(r"\n:10" + script_addr_low, re.IGNORECASE)
     start_script = None
-    within_range = False
-    # Look for the script start address
-    for loc, val in enumerate(hex_lines):
-        if val[0:9] == ":02000004":
-            # Reached an extended address record, check if within script range
-            within_range = val[9:13].upper() == script_addr_high
-        elif (
-            within_range
-            and val[0:3] == ":10"
-            and val[3:7].upper() == script_addr_low
-        ):
-            start_script = loc
+    if embedded_hex.startswith(ela_record[1:] + script_addr_high):
+        ela_i = 0
+    else:
+        ela_i = embedded_hex.find(ela_record + script_addr_high)
+    while ela_i != -1:
+        # The range lasts until the next extended address record
+        next_ela_i = embedded_hex.find(ela_record, ela_i + 1)
+        if next_ela_i == -1:
+            next_ela_i = len(embedded_hex)
+        record = script_record.search(embedded_hex, ela_i, next_ela_i)
+        if record:
+            start_script = record.start() + 1
             break
+        ela_i = embedded_hex.find(ela_record + script_addr_high, next_ela_i)
     if start_script:
-        # Find the end of the script
+        # unhexlify discards the first line, so include the record before it
+        start_blob = embedded_hex.rfind("\n", 0, start_script - 1) + 1
+        # Find the end of the script, a record full of 0xFF bytes
         end_script = None
-        for loc, val in enumerate(hex_lines[start_script:]):
-            if val[9:41] == "FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF":
-                end_script = loc + start_script
+        end_marker = "F" * 32
+        end_i = embedded_hex.find(end_marker, start_script)
+        while end_i != -1:
+            if end_i - embedded_hex.rfind("\n", 0, end_i) == 10:
+                end_script = end_i - 9
                 break
+            end_i = embedded_hex.find(end_marker, end_i + 1)
+        if end_script:
+            blob = embedded_hex[start_blob : end_script - 1]
+        else:
+            # Without an end of script marker drop the last six records
+            hex_lines = embedded_hex[start_blob:].rsplit("\n", 6)
+            blob = hex_lines[0] if len(hex_lines) == 7 else ""
         # Pass the extracted hex through unhexlify
-        return unhexlify(
-            "\n".join(
-                hex_lines[start_script - 1 : end_script if end_script else -6]
-            )
-        )
+        return unhexlify(blob)
     return ""
 
 
@@ -416,11 +533,24 @@ def find_microbit():
     # Check what sort of operating system we're on.
     if os.name == "posix":
         # 'posix' means we're on Linux or OSX (Mac).
-        # Call the unix "mount" command to list the mounted volumes.
-        mount_output = check_output("mount").splitlines()
-        mounted_volumes = [x.split()[2] for x in mount_output]
+        if os.path.exists("/proc/self/mountinfo"):
+            # On Linux read the mounted volumes straight from the kernel
+            # rather than running a process. The mount point is the 5th field.
+            with open("/proc/self/mountinfo", "rb") as mountinfo:
+                mount_output = mountinfo.read().splitlines()
+            mounted_volumes = [x.split()[4] for x in mount_output]
+        else:
+            # Call the unix "mount" command to list the mounted volumes.
+            mount_output = check_output("mount").splitlines()
+            mounted_volumes = [x.split()[2] for x in mount_output]
         for volume in mounted_volumes:
             if volume.endswith(b"MICROBIT"):
+                # Spaces and the like are escaped as octal in mountinfo
+                volume = re.sub(
+                    br"\\([0-7]{3})",
+                    lambda m: struct.pack("B", int(m.group(1), 8)),
+                    volume,
+                )
                 return volume.decode("utf-8")  # Return a string not bytes.
     elif os.name == "nt":
         # 'nt' means we're on Windows.
@@ -454,7 +584,14 @@ def find_microbit():
         #
         old_mode = ctypes.windll.kernel32.SetErrorMode(1)
         try:
-            for disk in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+            # A bitmask of the drive letters in use (bit 0 is A:, 1 is B:...)
+            drives = ctypes.windll.kernel32.GetLogicalDrives()
+            for i, disk in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
+                #
+                # Don't bother looking if there's no drive with this letter
+                #
+                if not drives & (1 << i):
+                    continue
                 path = "{}:\\".format(disk)
                 #
                 # Don't bother looking if the drive isn't removable
@@ -477,7 +614,7 @@ def save_hex(hex_file, path):
     """
     Given a string representation of a hex file, this function copies it to
     the specified path thus causing the device mounted at that point to be
-    flashed.
+    flashed. The hex file can also be given already encoded as ASCII bytes.
 
     If the hex_file is empty it will raise a ValueError.
 
@@ -488,10 +625,21 @@ def save_hex(hex_file, path):
         raise ValueError("Cannot flash an empty .hex file.")
     if not path.endswith(".hex"):
         raise ValueError("The path to flash must be for a .hex file.")
-    with open(path, "wb") as output:
-        output.write(hex_file.encode("ascii"))
-        output.flush()
-        os.fsync(output.fileno())
+    if not isinstance(hex_file, bytes):
+        hex_file = hex_file.encode("ascii")
+    # Short writes are resumed from a view of the data, rather than a copy
+    data = memoryview(hex_file)
+    # Write the file with as few (and as large) writes as possible, as each
+    # write is turned into USB transfers to the micro:bit mass storage device
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(path, flags, 0o666)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def flash(
@@ -546,6 +694,7 @@ def flash(
             paths_to_microbits = [found_microbit]
     # Attempt to write the hex file to the micro:bit.
     if paths_to_microbits:
+        hex_paths = []
         for path in paths_to_microbits:
             if keepname and path_to_python:
                 hex_file_name = script_name_root + ".hex"
@@ -559,21 +708,124 @@ def flash(
                     print("Hexifying {} as: {}".format(script_name, hex_path))
             else:
                 print("Flashing Python to: {}".format(hex_path))
-            save_hex(micropython_hex, hex_path)
+            hex_paths.append(hex_path)
+        if len(hex_paths) == 1 or os.environ.get("UFLASH_NO_PARALLEL"):
+            for hex_path in hex_paths:
+                save_hex(micropython_hex, hex_path)
+        else:
+            # Each micro:bit is a separate USB drive, so rather than waiting
+            # for them one after another, write to several of them at once.
+            # The hex file is encoded once and shared by all the threads.
+            micropython_hex = micropython_hex.encode("ascii")
+            pending_paths = queue.Queue()
+            for hex_path in hex_paths:
+                pending_paths.put(hex_path)
+            errors = []
+
+            def save_hex_worker():
+                while True:
+                    try:
+                        hex_path = pending_paths.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        save_hex(micropython_hex, hex_path)
+                    except Exception as ex:
+                        errors.append(ex)
+
+            threads = [
+                threading.Thread(target=save_hex_worker)
+                for _ in range(min(_MAX_FLASH_THREADS, len(hex_paths)))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
     else:
         raise IOError("Unable to find micro:bit. Is it plugged in?")
 
 
+def inotify_watch(path):
+    """
+    Returns an inotify file descriptor watching the directory containing the
+    given file for writes and files moved into it (as some editors save a file
+    by renaming a temporary file).
+
+    Returns None if inotify is not available (it is Linux only).
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    directory = os.path.dirname(os.path.abspath(path))
+    if not isinstance(directory, bytes):
+        directory = directory.encode(sys.getfilesystemencoding())
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+        inotify_fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    if inotify_fd < 0:
+        return None
+    watch_descriptor = libc.inotify_add_watch(
+        inotify_fd, directory, _IN_CLOSE_WRITE | _IN_MOVED_TO
+    )
+    if watch_descriptor < 0:
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+
+def inotify_wait(inotify_fd, path):
+    """
+    Blocks until the inotify file descriptor reports an event for the given
+    file.
+
+    Also returns if the kernel's event queue overflowed, as an event for the
+    file may have been lost. Raises an IOError if the watch was removed (for
+    example because the directory was deleted or unmounted).
+    """
+    name = os.path.basename(path)
+    if not isinstance(name, bytes):
+        name = name.encode(sys.getfilesystemencoding())
+    while True:
+        events = os.read(inotify_fd, 4096)
+        i = 0
+        while i < len(events):
+            # Each event is a struct inotify_event followed by the file name
+            _, mask, _, name_length = struct.unpack_from("iIII", events, i)
+            i += struct.calcsize("iIII")
+            event_name = events[i : i + name_length].rstrip(b"\x00")
+            i += name_length
+            if mask & _IN_IGNORED:
+                raise IOError('Stopped watching "{}".'.format(path))
+            if mask & _IN_Q_OVERFLOW or event_name == name:
+                return
+
+
 def watch_file(path, func, *args, **kwargs):
     """
-    Watch a file for changes by polling its last modification time. Call the
-    provided function with *args and **kwargs upon modification.
+    Watch a file for changes. Call the provided function with *args and
+    **kwargs upon modification.
+
+    On Linux the kernel is asked to report when the file has been written to,
+    otherwise (or if the UFLASH_WATCH_POLL environment variable is set) the
+    last modification time of the file is polled every second.
     """
     if not path:
         raise ValueError("Please specify a file to watch")
     print('Watching "{}" for changes'.format(path))
     last_modification_time = os.path.getmtime(path)
+    inotify_fd = None
+    if not os.environ.get("UFLASH_WATCH_POLL"):
+        inotify_fd = inotify_watch(path)
     try:
+        if inotify_fd is not None:
+            while True:
+                inotify_wait(inotify_fd, path)
+                func(*args, **kwargs)
         while True:
             time.sleep(1)
             new_modification_time = os.path.getmtime(path)
@@ -583,6 +835,9 @@ def watch_file(path, func, *args, **kwargs):
             last_modification_time = new_modification_time
     except KeyboardInterrupt:
         pass
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
 
 
 def py2hex(argv=None):